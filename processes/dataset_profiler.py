@@ -1,11 +1,12 @@
 import logging
-import json
+import os
+from pathlib import Path
+from secrets import token_hex
 
+import orjson
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
-import os
-import pandas as pd
-from toolbox_runner import list_tools
-from toolbox_runner.run import get_remote_image_list
+
+from processes.podman_processor import PodmanProcessor
 
 LOGGER = logging.getLogger(__name__)
 
@@ -87,28 +88,59 @@ class DatasetProfilerProcessor(BaseProcessor):
             raise ProcessorExecuteError('Cannot process without a dataset')
 
         # load all images (podman images!)
-        images = get_remote_image_list()
-
-        in_dir = '/home/geoapi/in/' + df
-        out_dir = '/home/geoapi/out/' + df
-
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        images = PodmanProcessor.cached_remote_image_list()
+        image_name = next((image for image in images if 'profile' in image), None)
+        if image_name is None:
+            logging.error('Error in processes - dataset_profiler.py. Cannot find profile image.')
+            raise ProcessorExecuteError('Cannot find a profile image')
+
+        # strip a leading slash, pathlib would otherwise drop the base folder
+        folder = df.lstrip('/')
+        # the folder is given by the user and becomes a bind mount source, it must stay inside of the in and out
+        # folders. normpath resolves all '..', so only a leading '..' can leave them
+        folder = os.path.normpath(folder)
+        if folder == os.pardir or folder.startswith(os.pardir + os.sep):
+            logging.error('Invalid data folder: %s', df)
+            raise ProcessorExecuteError(f'Invalid data folder: {df}')
+        secrets = PodmanProcessor.get_secrets()
+        in_dir = Path(secrets['GEOAPI_PATH'], 'in', folder)  # path in container (mounted in '/data/geoapi' auf server)
+        out_dir = Path(secrets['GEOAPI_PATH'], 'out', folder)
+        # the podman socket belongs to the server, so the mounts need the server paths
+        server_path_in = os.path.join(secrets['DATA_PATH'], 'in', folder)
+        server_path_out = os.path.join(secrets['DATA_PATH'], 'out', folder)
+
+        out_dir.mkdir(parents=True, exist_ok=True)
 
         metadata = {
             "profile": {
                 "data": "/in/dataframe.csv"
             }
         }
-        with open(in_dir + '/parameters.json', 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=4)
+        # the file is only read by the tool, so write it compact
+        (in_dir / 'parameters.json').write_bytes(orjson.dumps(metadata))
 
         # df.to_csv(in_dir+'dataframe.csv')s
 
-        for image in images:
-            if 'profile' in image:
-                os.system(f"docker run --rm -t --network=host -v {in_dir}:/in -v {out_dir}:/out {image}")
-                # os.system(f"podman run -t --rm -it --network=host -v {in_dir}:/in -v {out_dir}:/out {image}")
+        mounts = [{'type': 'bind', 'source': server_path_in, 'target': '/in', 'read_only': True},
+                  {'type': 'bind', 'source': server_path_out, 'target': '/out'}]
+        container_name = f'dataset_profiler_{token_hex(5)}'
+
+        client = PodmanProcessor.get_client(secrets['PODMAN_URI'])
+        try:
+            container = PodmanProcessor.pull_run_image(client=client, image_name=image_name,
+                                                       container_name=container_name, mounts=mounts,
+                                                       network_mode='host')
+            exit_code = container.attrs.get('State', {}).get('ExitCode')
+            if exit_code != 0:
+                PodmanProcessor.write_logs(container, out_dir / 'tool_logs.txt')
+        finally:
+            # pull_run_image does not clean up, remove the container also if the run failed
+            PodmanProcessor.remove_container(client, container_name)
+
+        if exit_code != 0:
+            logging.error('Error in processes - dataset_profiler.py. Container exited with code %s', exit_code)
+            raise ProcessorExecuteError(f'Profiler container exited with code {exit_code}')
+
         res = 'completed'
 
         # tools = list_tools('ghcr', as_dict=True)
@@ -119,7 +151,7 @@ class DatasetProfilerProcessor(BaseProcessor):
         outputs = {
             'id': 'res',
             'value': res,
-            'dir': out_dir
+            'dir': str(out_dir)
         }
 
         return mimetype, outputs
@@ -1,6 +1,20 @@
+import functools
 import logging
+import threading
+import time
+
 from podman import PodmanClient
 
+# seconds to reuse the remote image list before asking the registry again
+IMAGE_LIST_TTL = 60
+
+# number of log lines of a finished container written to the server log, callers read the full logs themselves
+LOG_TAIL_LINES = 200
+
+_image_list_cache = {'timestamp': None, 'images': []}
+_image_list_lock = threading.Lock()
+
+
 class PodmanProcessor():
 
     def connect(uri='unix:///run/podman/podman.sock'):
@@ -11,7 +25,6 @@ class PodmanProcessor():
             logging.error("Podman service is NOT running")
             raise Exception("Podman service is NOT running")
         else:
-            print("Podman service is running")
             logging.info("Podman service is running")
             # TODO: There is a bug in the following code. Fix it
             # version = client.version()
@@ -23,32 +36,42 @@ class PodmanProcessor():
             # logging.info("Podman API: ", version["Components"][0]["Details"]["APIVersion"])
 
         return client
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_client(uri='unix:///run/podman/podman.sock'):
+        # Connect once per uri and share the client between executions
+        return PodmanProcessor.connect(uri)
+
+    @staticmethod
+    def cached_remote_image_list(ttl=IMAGE_LIST_TTL):
+        # toolbox_runner is only needed by the processes looking up remote images
+        from toolbox_runner.run import get_remote_image_list
+
+        with _image_list_lock:
+            now = time.monotonic()
+            if _image_list_cache['timestamp'] is None or now - _image_list_cache['timestamp'] > ttl:
+                _image_list_cache['images'] = get_remote_image_list()
+                _image_list_cache['timestamp'] = now
+            return _image_list_cache['images']
+
     @staticmethod
     def pull_run_image(client, image_name, container_name, environment=None, mounts=None, network_mode=None,
-                       volumes=None, command=None):
-        secrets = PodmanProcessor.get_secrets()
-        # Log available Docker image
-        logging.info(f"client.images.list() {client.images.list()}")
-        logging.info("The following images are available: ")
-        for i in client.images.list():
-            logging.info(f"Image ID: {i.id}, image name: {i.tags}") #{i.name}
-
-        # Pull the Docker image
-        print("image: ", client.images.list(filters={"reference": image_name}))
-        logging.info("image: ", client.images.list(filters={"reference": image_name}))
-        if not client.images.list(filters={"reference": image_name}):
-            print(f"Pulling Podman image: {image_name}")
+                       command=None):
+        # Pull the Docker image, let podman look up the reference instead of listing all images
+        local_images = client.images.list(filters={"reference": image_name})
+        logging.info(f"image: {local_images}")
+        if not local_images:
             logging.info(f"Pulling Podman image: {image_name}")
             client.images.pull(image_name)
 
-        existing_container = client.containers.list(filters={"name": container_name})
+        # all=True to also find stopped containers that still block the name
+        existing_container = client.containers.list(filters={"name": container_name}, all=True)
         if existing_container:
             # print(f"Container '{container_name}' already exists. Removing...")
             logging.info(f"Container '{container_name}' already exists. Removing...")
-            existing_container[0].stop()
             existing_container[0].remove(force=True)
 
-        print(f"Running Podman container: {container_name}")
         logging.info(f"Running Podman container: {container_name}")
         try:
             container = client.containers.run(
@@ -58,7 +81,6 @@ class PodmanProcessor():
                 environment=environment,
                 mounts=mounts,
                 network_mode=network_mode,
-                # volumes=volumes,
                 command=command,
                 remove=False
             )
@@ -70,28 +92,20 @@ class PodmanProcessor():
             container.start()
             logging.info("Container started")
 
-            # status of the container after starting
-            container.reload()
-            logging.info("Container reloaded")
-            # print("container starting status :", container.status)
-            logging.info("container starting status :", container.status)
-
-            # Print container logs
-            # print(f"Container '{container.name}' logs:")
-            logging.info(f" _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ Container '{container.name}' logs: _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ ")
-            for line in container.logs(stream=True):
-                # print(line.strip().decode('utf-8'))
-                logging.info(f" - - {line.decode('utf-8')} - - ")
-            logging.info(" _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ finished logs _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ ")
-
             # exit status code
             exit_status = container.wait()
             # print("exit_status :", exit_status)
             logging.info(f"exit_status : {exit_status}")
 
+            # Print the end of the container logs, only fetched if the record is emitted at all
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logs = b''.join(container.logs(tail=LOG_TAIL_LINES))
+                logging.info(f" _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ Container '{container.name}' logs: _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ ")
+                logging.info("%s", logs.decode('utf-8', errors='replace'))
+                logging.info(" _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ finished logs _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ ")
+
             # status of the container
             container.reload()
-            print("container  exiting status :", container.status)
             logging.info(f"container  exiting status : {container.status}")
 
             return container
@@ -103,12 +117,30 @@ class PodmanProcessor():
             logging.error(f"Cannot run client.container. Error: {e}")
             raise
         
-    def get_secrets(file_name="processes/secret.txt"):
+    @staticmethod
+    def write_logs(container, file_name):
+        # stream the full logs to disk, pull_run_image only logs their tail and they are lost with the container
+        try:
+            with open(file_name, 'wb') as f:
+                f.writelines(container.logs(stream=True, follow=False))
+            logging.error("Logs of failed container %s written to %s", container.name, file_name)
+        except Exception as e:
+            logging.error("Cannot write logs of container %s. Error: %s", container.name, e)
 
-        secrets = {}
+    @staticmethod
+    def remove_container(client, container_name):
+        # also finds containers that pull_run_image created but could not return because the run failed
+        try:
+            for container in client.containers.list(filters={"name": container_name}, all=True):
+                container.remove(force=True)
+        except Exception as e:
+            logging.error("Cannot remove container %s. Error: %s", container_name, e)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_secrets(file_name="processes/secret.txt"):
+        # the secrets do not change while the server runs, read the file only once per process
+        # split at the first '=' only, values (e.g. passwords) may contain '=' as well
         with open(file_name, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                key, value = line.strip().split('=')
-                secrets[key] = value
-        return secrets
+            lines = f.read().splitlines()
+        return dict(line.strip().split('=', 1) for line in lines if line.strip() and not line.startswith('#'))
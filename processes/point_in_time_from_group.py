@@ -1,16 +1,11 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
-import json
 from pathlib import Path
 
-import numpy as np
+import orjson
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
-import os
-import pandas as pd
-import polars as pl
-from pyproj import CRS, Transformer, Proj, transform
-from toolbox_runner import list_tools
-from toolbox_runner.run import get_remote_image_list
 
 LOGGER = logging.getLogger(__name__)
 
@@ -94,6 +89,48 @@ PROCESS_METADATA = {
 }
 
 
+def pick_value(lower, upper, time_obj, interpolation):
+    """
+    Get value and precision at a point in time from the neighbouring rows of a timeseries.
+
+    :param lower: last row at or before time_obj, as dict with 'row_tstamp', 'value' and 'precision'
+    :param upper: first row at or after time_obj, same keys as lower
+    :param time_obj: requested point in time
+    :param interpolation: 'nn', 'linear' or None to dismiss values that need interpolation
+    :returns: tuple of value and precision, (None, None) if no value is available. Null values of a neighbour are
+        not interpolated, an interpolated precision is None if one of the neighbours has none.
+    """
+    if lower['row_tstamp'] == time_obj:
+        return lower['value'], lower['precision']
+    elif interpolation is None:
+        return None, None
+    elif interpolation == "nn":  # come here if you have to interpolate
+        # before the first or after the last row, the only neighbour is the nearest
+        if lower['row_tstamp'] is None and upper['row_tstamp'] is None:
+            return None, None
+        elif lower['row_tstamp'] is None:
+            nearest_row = upper
+        elif upper['row_tstamp'] is None:
+            nearest_row = lower
+        elif upper['row_tstamp'] - time_obj < time_obj - lower['row_tstamp']:
+            nearest_row = upper
+        else:
+            nearest_row = lower
+        return nearest_row['value'], nearest_row['precision']
+    elif interpolation == "linear":
+        if lower['row_tstamp'] is None or upper['row_tstamp'] is None:
+            return None, None  # point in time is outside of the timeseries, nothing to interpolate from
+        if lower['value'] is None or upper['value'] is None:
+            return None, None  # skip null neighbours, the value is dismissed
+        weight = (time_obj - lower['row_tstamp']) / (upper['row_tstamp'] - lower['row_tstamp'])
+        value = lower['value'] + weight * (upper['value'] - lower['value'])
+        if lower['precision'] is None or upper['precision'] is None:
+            return value, None
+        return value, lower['precision'] + weight * (upper['precision'] - lower['precision'])
+    else:
+        raise ProcessorExecuteError('interpolation method not allowed')
+
+
 class PointInTimeFromGroup(BaseProcessor):
     """PointInTimeFromGroup Processor"""
 
@@ -107,15 +144,18 @@ class PointInTimeFromGroup(BaseProcessor):
         super().__init__(processor_def, PROCESS_METADATA)
 
     def execute(self, data):
+        # heavy imports only when the process runs, to keep the start of the pygeoapi workers fast
+        import polars as pl
+        from pyproj import Transformer
+
         print('In excecute')
         print('Data: ', data)
         fullpaths = {}  # Path(f'{PROCESSES_IN_DIR}/{folder}/')
 
         dataset_values = []
         dataset_precisions = []
-        x_coords = []
-        y_coords = []
         sources = []
+        coords_by_srid = defaultdict(list)  # (position in sources, coordinates) per srid
 
         in_dir_base = '/home/geoapi/in/'
 
@@ -130,77 +170,93 @@ class PointInTimeFromGroup(BaseProcessor):
         time_string = data.get('timestamp')
         print('timestring: ', time_string)
         time_obj = datetime.strptime(time_string, '%Y-%m-%dT%H:%M')
-        pd_time_obj = pd.to_datetime(time_string, format='%Y-%m-%dT%H:%M')
-        test_time_obj = datetime.strptime("1902-01-01T01:10", '%Y-%m-%dT%H:%M')
         print('time obj: ', time_obj)
         print('interpolation 1: ', data.get('interpolation'))
         interpolation = interpolation_map[data.get('interpolation')]
         print('interpolation: ', interpolation)
 
-        for i in datasets:
-            fullpaths[i] = Path(f'{in_dir_base}/{i}/')
-            print('fullpaths: ', fullpaths)
+        # one row frame to look up the neighbours of the requested point in time
+        target = pl.LazyFrame({'tstamp': [time_obj]})
+
+        def load_dataset(i):
+            """
+            Read value and precision at the point in time and the metadata of one dataset. Runs in a worker thread,
+            so results are returned and collected afterwards in the order of the datasets.
+            """
+            value, precision, metadata = None, None, None
             try:
                 # data = pd.read_csv(Path(f'{in_dir_base}/{i}/dataframe.csv'))
-                data = pl.read_csv(Path(f'{in_dir_base}/{i}/dataframe.csv'), try_parse_dates=True).to_pandas()
-                print('data["tstamp"]: ', data["tstamp"])
-                # data["tstamp"] = data["tstamp"].astype('datetime64[ns]')  # this should be faster than "to_datetime"
-                # print('data["tstamp"] 2: ', data["tstamp"])
+                data = pl.scan_csv(Path(f'{in_dir_base}/{i}/dataframe.csv'), try_parse_dates=True) \
+                    .with_columns(pl.col('tstamp').alias('row_tstamp')) \
+                    .sort('tstamp')
+                # last row at or before and first row at or after the point in time, read in a single pass
+                lower, upper = pl.collect_all([target.join_asof(data, on='tstamp', strategy='backward'),
+                                               target.join_asof(data, on='tstamp', strategy='forward')])
+                lower = lower.row(0, named=True)
+                upper = upper.row(0, named=True)
+                LOGGER.debug('lower: %s upper: %s', lower, upper)
+                value, precision = pick_value(lower, upper, time_obj, interpolation)
 
             except Exception as e:
                 print('data e: ', e)
 
-            # if data.loc[data['tstamp'].searchsorted(test_time_obj)]['tstamp'] == test_time_obj:
-            if data.loc[data['tstamp'].searchsorted(time_obj)]['tstamp'] == time_obj:
-                dataset_values.append(data.loc[data['tstamp'].searchsorted(time_obj)]['value'])
-                dataset_precisions.append(data.loc[data['tstamp'].searchsorted(time_obj)]['precision'])
-            elif interpolation is None:
-                pass
-            elif interpolation == "nn":  # come here if you have to interpolate
-                if data.loc[data['tstamp'].searchsorted(time_obj)]['tstamp'] - time_obj < \
-                    data.loc[data['tstamp'].searchsorted(time_obj) - 1]['tstamp'] - time_obj:
-                    nearest_row = data.loc[data['tstamp'].searchsorted(time_obj)]
-                else:
-                    nearest_row = data.loc[data['tstamp'].searchsorted(time_obj)]
-                dataset_values.append(nearest_row['value'])
-                dataset_precisions.append(nearest_row['precision'])
-            elif interpolation == "linear":
-                lower_tstamp = data.loc[data['tstamp'].searchsorted(time_obj) - 1]
-                greater_tstamp = data.loc[data['tstamp'].searchsorted(time_obj)]
-                interval = greater_tstamp - lower_tstamp
-                df = pd.DataFrame([lower_tstamp,
-                                   pd.Series(data={'tstamp': pd_time_obj, 'value': np.nan, 'precision': np.nan},
-                                             index=['tstamp', 'value', 'precision']),
-                                   greater_tstamp])
-                # df = pd.DataFrame([lower_tstamp, ('tstamp', time_obj, greater_tstamp])
-                # low_dist =
-            else:
-                raise ProcessorExecuteError('interpolation method not allowed')
-
             try:
-                f = open(f'{in_dir_base}/{i}/dataframe.json')
-                metadata = json.load(f)
+                metadata = orjson.loads(Path(f'{in_dir_base}/{i}/dataframe.json').read_bytes())
+            except Exception as e:
+                print('meta e: ', e)
+
+            return value, precision, metadata
+
+        # reading the files is I/O bound, so overlap the datasets in threads
+        with ThreadPoolExecutor() as executor:
+            results = list(executor.map(load_dataset, datasets))
+
+        coords = None
+        for i, (value, precision, metadata) in zip(datasets, results):
+            fullpaths[i] = Path(f'{in_dir_base}/{i}/')
+
+            if value is not None:
+                dataset_values.append(value)
+                dataset_precisions.append(precision)
+
+            if metadata is None:
+                continue
 
+            try:
                 coords = metadata['coordinates']
                 srid = metadata['srid']
                 type = metadata['type']
 
-                from_crs = CRS(f"epsg:{srid}")  # or whatever you want
-                transformer = Transformer.from_crs(from_crs, CRS("epsg:3857"))
+                coords_by_srid[srid].append((len(sources), coords))
+                sources.append(metadata)
 
-                new_coords = transformer.transform(coords[1], coords[0])
-                print('new_coords: ', new_coords)
+            except Exception as e:
+                print('meta e: ', e)
 
-                x_coords.append(new_coords[0])
-                y_coords.append(new_coords[1])
+        print('fullpaths: ', fullpaths)
 
-                sources.append(metadata)
+        # build one transformer per srid and transform all coordinates of that srid at once
+        x_coords = [None] * len(sources)
+        y_coords = [None] * len(sources)
+        for srid, positions in coords_by_srid.items():
+            try:
+                # always_xy: coordinates are given as (lon, lat) / (x, y), independent of the axis order of the srid
+                transformer = Transformer.from_crs(int(srid), 3857, always_xy=True)
+                new_x, new_y = transformer.transform([c[0] for _, c in positions], [c[1] for _, c in positions])
+                LOGGER.debug('new_coords: %s %s', new_x, new_y)
+
+                for (position, _), x, y in zip(positions, new_x, new_y):
+                    x_coords[position] = x
+                    y_coords[position] = y
 
             except Exception as e:
-                print('meta e: ', e)
+                LOGGER.warning('Cannot transform coordinates of srid %s, dismiss its sources: %s', srid, e)
 
-            # from_crs = CRS("epsg:4326")  # or whatever you want
-            # transformer = Transformer.from_crs(from_crs, CRS("epsg:3857"))
+        # drop sources whose coordinates could not be transformed
+        kept = [position for position, x in enumerate(x_coords) if x is not None and y_coords[position] is not None]
+        sources = [sources[position] for position in kept]
+        x_coords = [x_coords[position] for position in kept]
+        y_coords = [y_coords[position] for position in kept]
 
         # here you could check if required files are given and check format
         if coords is None or datasets is None or time_string is None:
@@ -211,8 +267,7 @@ class PointInTimeFromGroup(BaseProcessor):
         # in_dir = '/home/geoapi/in/' + path
         out_dir = f"/home/geoapi/out/{self.metadata['id']}"  # new in dir for next process
 
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
 
         metadata = {
             "variogram": {  # "data": "/in/dataframe.csv"
@@ -228,8 +283,9 @@ class PointInTimeFromGroup(BaseProcessor):
             }
         }
 
-        with open(in_dir + '/parameters.json', 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=4)
+        # the file is only read by the tool, so write it compact
+        with open(in_dir + '/parameters.json', 'wb') as f:
+            f.write(orjson.dumps(metadata))
 
         # df.to_csv(in_dir+'dataframe.csv')s
 
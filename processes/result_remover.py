@@ -27,6 +27,7 @@
 #
 # =================================================================
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import shutil
@@ -143,16 +144,39 @@ class ResultRemoverProcessor(BaseProcessor):
         not_removed = []
         error = []
 
-        def __remove_folder(folder_list, folder_location, removed_list, not_removed_list, error_list):
+        def __remove_folder(folder_location, folder):
             """
-            Actual function to delete from hard disc.
+            Actual function to delete from hard disc. Runs in a worker thread, one call per folder.
 
             Parameters
             ----------
-            folder_list : list
-                List of folder paths.
             folder_location : str
                 Location of folder to be removed.
+            folder : str
+                Folder path inside of the location.
+
+            Returns
+            -------
+            str or None
+                The error message if the folder was not removed, else None.
+
+            """
+            path = f'{secrets["GEOAPI_PATH"]}/{folder_location}/{folder}'
+
+            try:
+                shutil.rmtree(path, ignore_errors=False)
+            except Exception as e:
+                return str(e)
+            return None
+
+        def __remove_folders(folders, removed_list, not_removed_list, error_list):
+            """
+            Delete in and out folders in parallel, the folder trees are independent of each other.
+
+            Parameters
+            ----------
+            folders : list
+                List of tuples of folder location and folder path.
             removed_list : list
                 List to store the paths of removed folders.
             not_removed_list : list
@@ -166,12 +190,17 @@ class ResultRemoverProcessor(BaseProcessor):
                 A tuple containing the updated removed_list, not_removed_list, and error_list.
 
             """
-            for i in folder_list:
-                try:
-                    shutil.rmtree(f'{secrets["GEOAPI_PATH"]}/{folder_location}/{i}')
+            if not folders:
+                return removed_list, not_removed_list, error_list
+
+            with ThreadPoolExecutor(max_workers=min(32, len(folders))) as executor:
+                results = list(executor.map(lambda f: __remove_folder(*f), folders))
+
+            for (folder_location, i), e in zip(folders, results):
+                if e is None:
                     logging.info(f'Removed {folder_location} folder {i}')
                     removed_list.append(i)
-                except Exception as e:
+                else:
                     not_removed_list.append(i)
                     error_list.append(e)
                     logging.warning(f'Unable to remove {folder_location} folder {i}. Error: {e}')
@@ -191,13 +220,13 @@ class ResultRemoverProcessor(BaseProcessor):
                     removed_list.append(i)
                 except Exception as e:
                     not_removed_list.append(i)
-                    error_list.append(e)
+                    error_list.append(str(e))
                     logging.warning(f'Unable to remove tinydb entry {i}. Error: {e}')
 
             return removed_list, not_removed_list, error_list
 
-        removed, not_removed, error = __remove_folder(input_folders, 'in', removed, not_removed, error)
-        removed, not_removed, error = __remove_folder(output_folders, 'out', removed, not_removed, error)
+        folders = [('in', i) for i in input_folders] + [('out', i) for i in output_folders]
+        removed, not_removed, error = __remove_folders(folders, removed, not_removed, error)
         removed, not_removed, error = __remove_db_entry(job_list, removed, not_removed, error)
 
         outputs = {
@@ -30,14 +30,20 @@
 import logging
 import json
 import os
+from pathlib import Path
+from secrets import token_hex
+
+from dateutil.parser import isoparse
+import orjson
 
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 
 # from toolbox_runner import list_tools
-from toolbox_runner.run import get_remote_image_list
 
 from processes.podman_processor import PodmanProcessor
-from podman import PodmanClient
+
+#: Upper limit for the tool logs returned to the client, older output is cut off
+MAX_LOG_BYTES = 1024 * 1024
 
 #: Process metadata and description
 PROCESS_METADATA = {
@@ -127,6 +133,19 @@ PROCESS_METADATA = {
             'minOccurs': 1,  # expect the data is required
             'maxOccurs': 1,
         },
+        'return_logs': {
+            'title': 'Return tool logs',
+            'description': 'Return the logs of the tool with the result. The last 1 MiB of the logs is returned. '
+                           'Otherwise the logs are written to tool_logs.txt in the result directory and the '
+                           'path to this file is returned.',
+            'schema': {
+                'type': 'boolean',
+                'default': True,
+                'required': 'false'
+            },
+            'minOccurs': 0,  # expect the data is not required
+            'maxOccurs': 1,
+        },
         # 'integration': {
         #     'title': 'Define how result is handled on server.',
         #     'description': 'Set if the results should be written to disk. All = can improve processing, '
@@ -185,11 +204,13 @@ class VforwaterLoaderProcessor(BaseProcessor):
 
     def execute(self, data):
         mimetype = 'application/json'
-        path = f'vfw_loader_{os.urandom(5).hex()}'
+        # one suffix per run, shared by the data folders and the container name
+        run_id = token_hex(5)
+        path = f'vfw_loader_{run_id}'
 
         # load all images (podman images!)   Not used yet. Maybe for a latter implementation of tools
         # might still use docker. Fix geoprocessapi
-        # images = get_remote_image_list()
+        # images = PodmanProcessor.cached_remote_image_list()
         # logging.info(f"Available images are: {images}")
 
         # ________________ get and prepare input data _________________________
@@ -203,34 +224,80 @@ class VforwaterLoaderProcessor(BaseProcessor):
         #  none, so the parameter is not available for the user. Uncomment it when needed
         integration = data.get('integration', 'none')
 
-        user = data.get('User-Info', "NO_USER")
+        user = str(data.get('User-Info', "NO_USER"))
+        # the user name becomes a folder below the in and out directories, it must not point anywhere else
+        if user in ('', '.', '..') or os.path.basename(user) != user:
+            logging.error('Invalid user name: %s', user)
+            raise ProcessorExecuteError(f'Invalid user name: {user}')
+        return_logs = str(data.get('return_logs', True)).lower() not in ('false', '0')
 
         logging.info('Data is loaded')
 
-        try:
-            if not isinstance(reference_area, dict):
-                reference_area = json.loads(reference_area)
-
-            if 'geometry' in reference_area and isinstance(reference_area['geometry'], str):
-                reference_area['geometry'] = json.loads(reference_area['geometry'])
-
-            dataset_ids = timeseries_ids
-            dataset_ids.extend(raster_ids)
-            if len(dataset_ids) == 0:
-                logging.info('The input data is not complete.')
-                # raise ProcessorExecuteError('Cannot process without required datasets')
-                return json.dumps({'warning': 'Running this tool makes no sense without timeseries or areal dataset.'})
-        except Exception as e:
-            logging.debug(f"Problem while concatenate data: {e}")
+        if reference_area:
+            try:
+                if isinstance(reference_area, (str, bytes)):
+                    reference_area = orjson.loads(reference_area)
+            except orjson.JSONDecodeError as e:
+                logging.error('Cannot parse reference area: %s', e)
+                raise ProcessorExecuteError(f'Cannot parse reference area: {e}')
 
-        logging.info(f"Got input dataset ids: {dataset_ids},   start date: {start_date},   end date: {end_date},   "
-                     f"reference area: {reference_area}")
+            if not isinstance(reference_area, dict):
+                logging.error('Reference area is not a GeoJSON object: %s', reference_area)
+                raise ProcessorExecuteError('Reference area has to be a GeoJSON object')
+
+            try:
+                if isinstance(reference_area.get('geometry'), (str, bytes)):
+                    reference_area['geometry'] = orjson.loads(reference_area['geometry'])
+            except orjson.JSONDecodeError as e:
+                logging.error('Cannot parse reference area: %s', e)
+                raise ProcessorExecuteError(f'Cannot parse reference area: {e}')
+
+        # a single id must not be unpacked character by character, null is the same as no ids
+        ids = {'timeseries_ids': timeseries_ids, 'raster_ids': raster_ids}
+        for name, value in ids.items():
+            if value is None:
+                ids[name] = []
+            elif isinstance(value, (str, int)) and not isinstance(value, bool):
+                ids[name] = [value]
+            elif not isinstance(value, (list, tuple)):
+                logging.error('Invalid %s: %s', name, value)
+                raise ProcessorExecuteError(f'{name} has to be a list of dataset ids')
+        timeseries_ids, raster_ids = ids['timeseries_ids'], ids['raster_ids']
+
+        # new list, extending timeseries_ids would change the input data of the job. Drop duplicates, so the tool
+        # does not load the same dataset twice
+        dataset_ids = list(dict.fromkeys([*timeseries_ids, *raster_ids]))
+        if len(dataset_ids) < len(timeseries_ids) + len(raster_ids):
+            logging.warning('Removed duplicate dataset ids from input, loading: %s', dataset_ids)
+        if not dataset_ids:
+            logging.info('The input data is not complete.')
+            # raise ProcessorExecuteError('Cannot process without required datasets')
+            return json.dumps({'warning': 'Running this tool makes no sense without timeseries or areal dataset.'})
+
+        logging.info("Got input dataset ids: %s,   start date: %s,   end date: %s,   reference area: %s",
+                     dataset_ids, start_date, end_date, reference_area)
 
         # here you could check if required files are given and check format
         if dataset_ids is None or start_date is None or end_date is None:
             logging.error('Cannot process without required datasets')
             raise ProcessorExecuteError('Cannot process without required datasets')
 
+        # fail before the container is started, if a given date cannot be parsed
+        dates = {}
+        for name, value in (('start_date', start_date), ('end_date', end_date)):
+            if value:
+                try:
+                    dates[name] = isoparse(value)
+                except (ValueError, TypeError) as e:
+                    logging.error('Invalid %s %s: %s', name, value, e)
+                    raise ProcessorExecuteError(f'Invalid {name} {value}: {e}')
+
+        start, end = dates.get('start_date'), dates.get('end_date')
+        # naive and timezone aware dates cannot be compared, the tool will handle them
+        if start and end and (start.tzinfo is None) == (end.tzinfo is None) and start > end:
+            logging.error('start_date %s is after end_date %s', start_date, end_date)
+            raise ProcessorExecuteError(f'start_date {start_date} is after end_date {end_date}')
+
         input_dict = {
             "vforwater_loader": {
                 "parameters": {
@@ -242,32 +309,28 @@ class VforwaterLoaderProcessor(BaseProcessor):
                 }
             }}
 
-        logging.info(f"Input for tool is: {input_dict}.")
+        logging.info("Input for tool is: %s.", input_dict)
 
         # For testing use no inputs but the example of mirko
         # input_dict['vforwater_loader']['parameters'] = PROCESS_METADATA['example']['inputs']  # job fails
         # input_dict = PROCESS_METADATA['example']['inputs']  # job runs through but no result
 
-        logging.info(f'Created json input for tool: {input_dict}')
+        logging.info('Created json input for tool: %s', input_dict)
 
         secrets = PodmanProcessor.get_secrets()
-        host_path_in = f'{secrets["GEOAPI_PATH"]}/in/{user}/{path}'  # path in container (mounted in '/data/geoapi' auf server)
-        host_path_out = f'{secrets["GEOAPI_PATH"]}/out/{user}/{path}'  # path in container (mounted in '/data/geoapi' auf server)
+
+        host_path_in = os.path.join(secrets['GEOAPI_PATH'], 'in', user, path)  # path in container (mounted in '/data/geoapi' auf server)
+        host_path_out = os.path.join(secrets['GEOAPI_PATH'], 'out', user, path)  # path in container (mounted in '/data/geoapi' auf server)
         # host_path_in = f'/home/geoapi/in/{user}/{path}'  # path in container (mounted in '/data/geoapi' auf server)
         # host_path_out = f'/home/geoapi/out/{user}/{path}'  # was out_dir
 
-        if not os.path.exists(host_path_in):
-            os.makedirs(host_path_in)
-            logging.debug(f'Created input directory at: {host_path_in}')
-
-        if not os.path.exists(host_path_out):
-            os.makedirs(host_path_out)
-            logging.debug(f'Created output directory at: {host_path_out}')
+        for host_path in (host_path_in, host_path_out):
+            os.makedirs(host_path, exist_ok=True)
+        logging.debug('Use input directory at: %s and output directory at: %s', host_path_in, host_path_out)
 
-        with open(f'{host_path_in}/inputs.json', 'w', encoding='utf-8') as f:
-            json.dump(input_dict, f, ensure_ascii=False, indent=4)
+        Path(host_path_in, 'inputs.json').write_bytes(orjson.dumps(input_dict))
 
-        logging.debug(f'wrote json to {host_path_in}/inputs.json')
+        logging.debug('wrote json to %s/inputs.json', host_path_in)
 
         # ________________  prepare data to run container _________________________
         logging.info('Prepare container data')
@@ -275,24 +338,18 @@ class VforwaterLoaderProcessor(BaseProcessor):
         image_name = 'tool_vforwater_loader:0.2' # TODO: used for test; still valid?
         # image_name = 'tool_vforwater_loader:latest'
         # image_name = 'ghcr.io/vforwater/tbr_vforwater_loader:latest'
-        container_name = f'tool_vforwater_loader_{os.urandom(5).hex()}'
+        container_name = f'tool_vforwater_loader_{run_id}'
 
         container_in = '/in'
         container_out = '/out'
 
-        server_path_in = f'{secrets["DATA_PATH"]}/in/{user}/{path}'  # path in container (mounted in '/data/geoapi' auf server)
-        server_path_out = f'{secrets["DATA_PATH"]}/out/{user}/{path}'  # was out_dir
+        server_path_in = os.path.join(secrets['DATA_PATH'], 'in', user, path)  # path in container (mounted in '/data/geoapi' auf server)
+        server_path_out = os.path.join(secrets['DATA_PATH'], 'out', user, path)  # was out_dir
 
         mounts = [{'type': 'bind', 'source': '/data', 'target': '/data', 'read_only': True},
                   {'type': 'bind', 'source': server_path_in, 'target': container_in, 'read_only': True},
                   {'type': 'bind', 'source': server_path_out, 'target': container_out}]  # mal entfernen in pull run
-        logging.info(f'use mounts: {mounts}')
-
-        volumes = {  # sollte funktionieren
-            host_path_in: {'bind': container_in, 'mode': 'rw'},  # container_in = '/in'
-            host_path_out: {'bind': container_out, 'mode': 'rw'}  # container_out = '/out'
-        }
-        logging.info(f'use volumes: {volumes}')
+        logging.info('use mounts: %s', mounts)
 
         environment = {
             'METACATALOG_URI':
@@ -304,60 +361,48 @@ class VforwaterLoaderProcessor(BaseProcessor):
         # use python podman
         error = 'none'
         try:
-            client = PodmanProcessor.connect(secrets['PODMAN_URI'])
-            logging.info(f'use client: {client}')
+            client = PodmanProcessor.get_client(secrets['PODMAN_URI'])
+            logging.info('use client: %s', client)
 
             container = PodmanProcessor.pull_run_image(client=client, image_name=image_name,
                                                        container_name=container_name, environment=environment,
-                                                       mounts=mounts, network_mode=network_mode, volumes=volumes,
+                                                       mounts=mounts, network_mode=network_mode,
                                                        command=command)
-            logging.info(f'running container: {container}')
+            logging.info('running container: %s', container)
         except Exception as e:
-            print(f'Error running Podman: {e}')
-            logging.error(f'Error running Podman: {e}')
+            logging.error('Error running Podman: %s', e)
             error = e
 
         status = 'failed'
         tool_logs = 'Found no logs inside of tool'
-        try:  # try to get info about container
-            container.reload()
+        try:  # try to get info about container, pull_run_image reloaded it after the container exited
             status = container.status
-            logging.info(f"Podman status before remove is {status}")
-            logs_generator = container.logs()
-            tool_logs = ''.join(log.decode('utf-8') for log in logs_generator)
+            logging.info("Podman status before remove is %s", status)
+            if return_logs:
+                logs = b''.join(container.logs())
+                tool_logs = logs[-MAX_LOG_BYTES:].decode('utf-8', errors='replace')
+            else:
+                # pass the logs by reference, write the chunks as they come instead of keeping them in memory
+                with open(os.path.join(host_path_out, 'tool_logs.txt'), 'wb') as f:
+                    f.writelines(container.logs(stream=True, follow=False))
+                tool_logs = os.path.join(server_path_out, 'tool_logs.txt')
             # tool_logs = logs.decode('utf-8')
         except Exception as e:
-            logging.error(f'Error running Podman: {e}')
+            logging.error('Error running Podman: %s', e)
             error = f'1: Container Exception: {error} --- 2: Get status Exception {e}'
 
         # container.remove()
-        print("podman run completed!")
         logging.info("Podman run completed!")
 
-        # for development hardcode the image
-        # image = "ghcr.io/vforwater/tbr_vforwater_loader"
-        # logging.debug(f'Use image: {image}')
-        # os.system(
-        #     f"podman run -t --rm -it --network=host -v {in_dir}:/in -v {out_dir}:/out -e TOOL_RUN=tool_vforwater_loader {image}")
-        # for image in images:
-        #     logging.debug(f'Found image: {image}')
-        #     if 'tbr_vforwater_loader' in image:
-        #         # os.system(f"docker run --rm -t --network=host -v {in_dir}:/in -v {out_dir}:/out -e TOOL_RUN=variogram {image}")
-        #         os.system(f"podman run -t --rm -it --network=host -v {in_dir}:/in -v {out_dir}:/out -e TOOL_RUN=tool_vforwater_loader {image}")
-        #     else:
-        #         print('Error in processes - tool_vforwater_loader.py. Cannot load docker image.')
-        #         logging.error('Error in processes - tool_vforwater_loader.py. Cannot load docker image.')
-
         res = 'completed'
 
         # tools = list_tools('ghcr', as_dict=True)
         # prof = tools.get('profile')
         # dataset = pd.read_csv(df)
         # res = prof.run(result_path='out/', data=dataset)
-        logging.info(f" - container_status: {type(status), status}")
-        logging.info(f" - host_path_out: {type(host_path_out), host_path_out}")
-        logging.info(f" - error: {type(error), error}")
-        logging.info(f" - tool_logs: {type(tool_logs), tool_logs}")
+        logging.info("container_status: %s, host_path_out: %s, error: %s", status, host_path_out, error)
+        # the container logs were already written by pull_run_image
+        logging.debug("tool_logs: %s", tool_logs)
 
         outputs = {
             # 'id': 'res',
@@ -370,7 +415,7 @@ class VforwaterLoaderProcessor(BaseProcessor):
             'tool_logs': tool_logs
         }
 
-        logging.info(f'Finished execution of vforwater loader. return {mimetype, outputs}')
+        logging.info('Finished execution of vforwater loader. return %s', (mimetype, outputs))
         return mimetype, outputs
 
     def __repr__(self):
@@ -1,11 +1,14 @@
 import logging
-import json
+import os
+from pathlib import Path
+from secrets import token_hex
+import shutil
+import time
 
+import orjson
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
-import os
-import pandas as pd
-from toolbox_runner import list_tools
-from toolbox_runner.run import get_remote_image_list
+
+from processes.podman_processor import PodmanProcessor
 
 LOGGER = logging.getLogger(__name__)
 
@@ -281,6 +284,20 @@ PROCESS_METADATA = {
     }
 }
 
+#: dictionaries to map inputs to options of tool
+BIN_FUNC_MAP = {'Even': 'even', 'Uniform': 'uniform', 'Freedman-Diaconis estimator': 'fd',
+                'Sturge’s rule': 'sturges', 'Scott’s rule': 'scott', 'Doane’s extension': 'doane',
+                'Square-root of distance': 'sqrt', 'KMeans clustering': 'kmeans',
+                'Hierarchical clustering': 'ward'}
+MODEL_MAP = {'Spherical': 'spherical', 'Exponential': 'exponential', 'Gaussian': 'gaussian', 'Cubic': 'cubic',
+             'Stable model': 'stable', 'Matérn model': 'matern', 'Nugget effect variogram': 'nugget'}
+ESTIMATOR_MAP = {'Matheron estimator': 'matheron', 'Cressie-Hawkins': 'cressie', 'Dowd-Estimator': 'dowd',
+                 'Genton': 'genton', 'MinMax Scaler': 'minmax', 'Shannon Entropy': 'entropy'}
+FIT_METHOD_MAP = {'Levenberg-Marquardt algorithm': 'lm', 'Trust Region Reflective': 'trf',
+                  'Maximum-Likelihood estimation': 'ml', 'Manual fitting': 'manual'}
+FIT_SIGMA_MAP = {'Linear loss with distance': 'linear', 'Exponential decrease': 'esp',
+                 'Square Root of distance decrease': 'sqrt', 'Squared distance decrease': 'sq', 'None': 'None'}
+
 
 class VariogramProcessor(BaseProcessor):
     """variogram Processor"""
@@ -298,56 +315,92 @@ class VariogramProcessor(BaseProcessor):
 
         mimetype = 'application/json'
 
-        # load all images (podman images!)
-        images = get_remote_image_list()
+        # check the required inputs before anything else is done
+        missing = [key for key in ('coordinates', 'values', 'n_lags', 'bin_func', 'model', 'estimator', 'fit_method',
+                                   'use_nugget') if data.get(key) is None]
+        if missing:
+            raise ProcessorExecuteError(f'Cannot process without inputs: {", ".join(missing)}')
 
-        # dictionaries to map inputs to options of tool
-        bin_func_map = {'Even': 'even', 'Uniform': 'uniform', 'Freedman-Diaconis estimator': 'fd',
-                        'Sturge’s rule': 'sturges', 'Scott’s rule': 'scott', 'Doane’s extension': 'doane',
-                        'Square-root of distance': 'sqrt', 'KMeans clustering': 'kmeans',
-                        'Hierarchical clustering': 'ward'}
-        model_map = {'Spherical': 'spherical', 'Exponential': 'exponential', 'Gaussian': 'gaussian', 'Cubic': 'cubic',
-                     'Stable model': 'stable', 'Matérn model': 'matern', 'Nugget effect variogram': 'nugget'}
-        estimator_map = {'Matheron estimator': 'matheron', 'Cressie-Hawkins': 'cressie', 'Dowd-Estimator': 'dowd',
-                         'Genton': 'genton', 'MinMax Scaler': 'minmax', 'Shannon Entropy': 'entropy'}
-        fit_method_map = {'Levenberg-Marquardt algorithm': 'lm', 'Trust Region Reflective': 'trf',
-                          'Maximum-Likelihood estimation': 'ml', 'Manual fitting': 'manual'}
-        fit_sigma_map = {'Linear loss with distance': 'linear', 'Exponential decrease': 'esp',
-                         'Square Root of distance decrease': 'sqrt', 'Squared distance decrease': 'sq', 'None': 'None'}
+        # load all images (podman images!), the list is cached for all processes
+        images = PodmanProcessor.cached_remote_image_list()
+        image = next((image for image in images if 'skgstat' in image), None)
+        if image is None:
+            logging.error('Error in processes - variogram.py. Cannot find skgstat image.')
+            raise ProcessorExecuteError('Cannot find a skgstat image')
 
         # collect inputs
         coords = data.get('coordinates')  # path/name to numpy.ndarray
         values = data.get('values')  # path/name to numpy.ndarray
         n_lags = data.get('n_lags')  # integer
-        bin_func = bin_func_map[data.get('bin_func')]  # string
-        model = model_map[data.get('model')]  # string
-        estimator = estimator_map[data.get('estimator')]  # string
+        try:
+            if isinstance(n_lags, bool) or float(n_lags) != int(float(n_lags)):
+                raise ValueError
+            n_lags = int(float(n_lags))
+        except (TypeError, ValueError, OverflowError):
+            raise ProcessorExecuteError(f'Invalid n_lags {n_lags}, it has to be an integer')
+        if n_lags < 3:
+            raise ProcessorExecuteError(f'Invalid n_lags {n_lags}, at least 3 lag classes are needed')
+        try:
+            bin_func = BIN_FUNC_MAP[data.get('bin_func')]  # string
+            model = MODEL_MAP[data.get('model')]  # string
+            estimator = ESTIMATOR_MAP[data.get('estimator')]  # string
+            fit_method = FIT_METHOD_MAP[data.get('fit_method')]  # string
+        except KeyError as e:
+            raise ProcessorExecuteError(f'Invalid option for variogram: {e}')
         maxlag = data.get('maxlag')  # float or string ['median', 'mean']
-        fit_method = fit_method_map[data.get('fit_method')]  # string
-        use_nugget = data.get('use_nugget')  # boolean
+        if maxlag is not None and maxlag not in ('median', 'mean'):
+            try:
+                maxlag = float(maxlag)
+            except (TypeError, ValueError):
+                raise ProcessorExecuteError(f'Invalid maxlag {maxlag}, use "median", "mean" or a number')
+            if maxlag <= 0:
+                raise ProcessorExecuteError(f'Invalid maxlag {maxlag}, a number has to be larger than 0')
+        use_nugget = data.get('use_nugget')  # boolean, but may be given as string like the default
+        if not isinstance(use_nugget, bool):
+            use_nugget = str(use_nugget).lower() == 'true'
         fit_range = data.get('fit_range')  # float
         fit_sill = data.get('fit_sill')  # float
         fit_nugget = data.get('fit_nugget')  # float
+        if fit_method == 'manual' and (fit_range is None or fit_sill is None):
+            raise ProcessorExecuteError('Manual fitting needs fit_range and fit_sill')
         fit_sigma = data.get('fit_sigma')  # # string or array
-        # fit_sigma = fit_sigma_map[data.get('fit_sigma')]  # float or array
+        # fit_sigma = FIT_SIGMA_MAP[data.get('fit_sigma')]  # float or array
 
-        # here you could check if required files are given and check format
-        if coords is None or values is None or n_lags is None or bin_func is None or model is None \
-            or estimator is None or fit_method is None or use_nugget is None:
-            raise ProcessorExecuteError('Cannot process without a dataset')
+        def data_file(name, value):
+            # the files are given relative to the in folder by the user and become bind mount sources, they must stay
+            # inside of it. normpath resolves all '..', so only a leading '..' can leave it
+            relative = os.path.normpath(str(value).lstrip('/'))
+            if relative in (os.curdir, os.pardir) or relative.startswith(os.pardir + os.sep):
+                logging.error('Invalid %s: %s', name, value)
+                raise ProcessorExecuteError(f'Invalid {name}: {value}')
+            return relative
 
-        path = os.path.dirname(values)
+        coords_file = data_file('coordinates', coords)
+        values_file = data_file('values', values)
+        if os.path.basename(coords_file) == os.path.basename(values_file) and coords_file != values_file:
+            raise ProcessorExecuteError('coordinates and values need different file names')
+        if 'parameters.json' in (os.path.basename(coords_file), os.path.basename(values_file)):
+            raise ProcessorExecuteError('parameters.json is reserved for the run parameters')
+        folder = os.path.dirname(values_file)
 
-        in_dir = '/home/geoapi/in/' + path
-        out_dir = '/home/geoapi/out/' + path
+        # Every run gets its own in and out folder, so concurrent runs on the same values do not overwrite each other.
+        # The in folder only holds the parameters, the data files are mounted into it
+        run_id = token_hex(5)
+        secrets = PodmanProcessor.get_secrets()
+        run_in_dir = Path(secrets['GEOAPI_PATH'], 'in', f'variogram_{run_id}')  # path in container
+        out_dir = Path(secrets['GEOAPI_PATH'], 'out', folder, f'variogram_{run_id}')
+        # the podman socket belongs to the server, so the mounts need the server paths
+        server_path_in = os.path.join(secrets['DATA_PATH'], 'in')
+        server_run_in = os.path.join(server_path_in, f'variogram_{run_id}')
+        server_path_out = os.path.join(secrets['DATA_PATH'], 'out', folder, f'variogram_{run_id}')
 
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        for run_dir in (run_in_dir, out_dir):
+            run_dir.mkdir(parents=True, exist_ok=True)
 
         metadata = {
             "variogram": {  # "data": "/in/dataframe.csv"
-                "coords": f"/in/{coords}",
-                "values": f"/in/{values}",
+                "coords": f"/in/{os.path.basename(coords_file)}",
+                "values": f"/in/{os.path.basename(values_file)}",
                 "n_lags": n_lags,
                 "bin_func": bin_func,
                 "model": model,
@@ -362,17 +415,44 @@ class VariogramProcessor(BaseProcessor):
             }
         }
 
-        with open(in_dir + '/parameters.json', 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=4)
+        # the file is only read by the tool, so write it compact
+        (run_in_dir / 'parameters.json').write_bytes(orjson.dumps(metadata))
 
         # df.to_csv(in_dir+'dataframe.csv')s
 
-        for image in images:
-            if 'skgstat' in image:
-                # os.system(f"docker run --rm -t --network=host -v {in_dir}:/in -v {out_dir}:/out -e TOOL_RUN=variogram {image}")
-                os.system(f"podman run -t --rm -it --network=host -v {in_dir}:/in -v {out_dir}:/out -e TOOL_RUN=variogram {image}")
-            else:
-                print('Error in processes - variogram.py. Cannot load docker image.')
+        # the run folder read-only at /in with the data files mounted into it. /in is read-only, so the mount points
+        # of the files have to exist before the container starts
+        mounts = [{'type': 'bind', 'source': server_run_in, 'target': '/in', 'read_only': True},
+                  {'type': 'bind', 'source': server_path_out, 'target': '/out'}]
+        for data_path in dict.fromkeys((coords_file, values_file)):
+            (run_in_dir / os.path.basename(data_path)).touch()
+            mounts.append({'type': 'bind', 'source': os.path.join(server_path_in, data_path),
+                           'target': f'/in/{os.path.basename(data_path)}', 'read_only': True})
+        container_name = f'variogram_{run_id}'
+
+        # talk to the podman socket directly, the container logs are written by pull_run_image
+        start = time.perf_counter()
+        client = PodmanProcessor.get_client(secrets['PODMAN_URI'])
+        try:
+            container = PodmanProcessor.pull_run_image(client=client, image_name=image,
+                                                       container_name=container_name,
+                                                       environment={'TOOL_RUN': 'variogram'}, mounts=mounts,
+                                                       network_mode='host')
+            exit_code = container.attrs.get('State', {}).get('ExitCode')
+            if exit_code != 0:
+                PodmanProcessor.write_logs(container, out_dir / 'tool_logs.txt')
+        finally:
+            # pull_run_image does not clean up, remove the container also if the run failed
+            PodmanProcessor.remove_container(client, container_name)
+            # the run folder only holds the parameters and mount points, nothing to keep
+            shutil.rmtree(run_in_dir, ignore_errors=True)
+        duration = time.perf_counter() - start
+
+        logging.info('Variogram container of image %s for %s exited with code %s after %.2f s',
+                     image, out_dir, exit_code, duration)
+        if exit_code != 0:
+            logging.error('Error in processes - variogram.py. Container exited with code %s', exit_code)
+            raise ProcessorExecuteError(f'Variogram container exited with code {exit_code}')
 
         res = 'completed'
 
@@ -384,7 +464,7 @@ class VariogramProcessor(BaseProcessor):
         outputs = {
             'id': 'res',
             'value': res,
-            'dir': out_dir
+            'dir': str(out_dir)
         }
 
         return mimetype, outputs